@@ -1,11 +1,20 @@
 """The application's user interface including the terminal-based menu and the experimental procedure itself."""
 
+import atexit
 import copy
 import datetime
+import math
 import os
+import queue
 import random
 import re
 import readline
+import select
+import shutil
+import signal
+import stat
+import sys
+import textwrap
 import threading
 import time
 
@@ -15,40 +24,106 @@ from src import version
 
 
 _LEFT_MARGIN_WIDTH = 2
+_MARGIN = ' ' * _LEFT_MARGIN_WIDTH
+_LOGFILE_PROBE_SIZE = 4096
+_LOGFILE_BUFFER_SIZE = 8192
+
+# accepted answers in the test phase, 'g'rammatical and 'u'ngrammatical included
+_YES = frozenset('yg')
+_NO = frozenset('nu')
+
+_RE_WORD = re.compile(r'\A\w+\Z')
+_RE_HAS_DIGIT = re.compile(r'\d')
+_RE_MIXED_CASE = re.compile(r'(?=.*[A-Z])(?=.*[a-z])')
+_RE_CR = re.compile(r'\r')
+_RE_AGL = re.compile(r'agl-solitaire')
 
 _builtin_print = print
 
+_WRAPPER = textwrap.TextWrapper(initial_indent=_MARGIN,
+                                subsequent_indent=_MARGIN,
+                                expand_tabs=False,
+                                replace_whitespace=False,
+                                break_long_words=False,  # one giant word, we leave it unwrapped
+                                break_on_hyphens=False)
+
+_terminal_width = None
+_previous_sigwinch_handler = None
+
+def _refresh_terminal_width():
+    """Look up the current width of the terminal."""
+    global _terminal_width
+    # falls back to a sensible default if we're not attached to a terminal
+    _terminal_width = shutil.get_terminal_size(fallback=(80, 24)).columns
+
+def _handle_sigwinch(signum, frame):
+    """Keep up with the terminal being resized, then let the previous handler do the same."""
+    _refresh_terminal_width()
+    if callable(_previous_sigwinch_handler):
+        _previous_sigwinch_handler(signum, frame)
+
+def _install_sigwinch_handler():
+    """Track the terminal width on SIGWINCH without taking the signal away from anyone else."""
+    global _previous_sigwinch_handler
+    if not hasattr(signal, 'SIGWINCH'):
+        return  # not available on Windows
+    previous = signal.getsignal(signal.SIGWINCH)
+    if previous is None or previous is _handle_sigwinch:
+        return  # installed outside Python so we couldn't pass it on, or already ours
+    _previous_sigwinch_handler = previous
+    signal.signal(signal.SIGWINCH, _handle_sigwinch)
+
 def print(string='', end='\n'):
     """Smarter print function, adds left margin and wraps long lines automatically."""
-    max_width = os.get_terminal_size().columns
-    wrapped_string = ''
-    for line in string.split('\n'):
-        carriage_return = re.match(r'\r', line)
+    if _terminal_width is None:
+        _refresh_terminal_width()
+    lines = string.split('\n')
+    if '\r' not in string and _LEFT_MARGIN_WIDTH + max(map(len, lines)) <= _terminal_width:
+        # nothing to wrap, just indent every line in one go
+        _builtin_print(_MARGIN + string.replace('\n', '\n' + _MARGIN), end=end)
+        return
+    _WRAPPER.width = _terminal_width
+    wrapped_lines = []
+    for line in lines:
+        carriage_return = _RE_CR.match(line)
         if carriage_return:
             line = line[1:]
-        line = ' ' * _LEFT_MARGIN_WIDTH + line
+        if _LEFT_MARGIN_WIDTH + len(line) <= _terminal_width:
+            # fits as it is, which is most of the time
+            wrapped = [_MARGIN + line]
+        else:
+            wrapped = _WRAPPER.wrap(line) or [_MARGIN]
         if carriage_return:
-            line = '\r' + line
-        while max_width < len(line):
-            stop_at = max_width - 1
-            # back up to the nearest word boundary
-            while 0 <= stop_at and not line[stop_at].isspace():
-                stop_at -= 1
-            if -1 == stop_at:
-                # one giant word, we give up and leave it unwrapped
-                stop_at = len(line)
-            wrapped_string += line[:stop_at] + '\n'
-            line = line[stop_at+1:]
-            line = ' ' * _LEFT_MARGIN_WIDTH + line
-        wrapped_string += line + '\n'
-    # leave off the last newline
-    _builtin_print(wrapped_string[:-1], end=end)
+            wrapped[0] = '\r' + wrapped[0]
+        wrapped_lines.extend(wrapped)
+    _builtin_print('\n'.join(wrapped_lines), end=end)
 
 _builtin_input = input
 
 def input(prompt=''):
     """input function with constant left margin for improved readability."""
-    return _builtin_input(' ' * _LEFT_MARGIN_WIDTH + prompt)
+    return _builtin_input(_MARGIN + prompt)
+
+def input_lines():
+    """Keep reading lines of input until an empty line is entered."""
+    lines = []
+    interactive = sys.stdin.isatty()
+    while True:
+        # skip readline's overhead if the input is piped in
+        line = input() if interactive else sys.stdin.readline().rstrip('\n')
+        if not line:
+            return lines
+        lines.append(line)
+
+_CLEAR_COMMAND = 'cls' if 'nt' == os.name else 'clear'
+
+def clear():
+    """Wipe the terminal screen, without spawning a subprocess if the terminal understands ANSI codes."""
+    if sys.stdout.isatty() and os.environ.get('TERM') != 'dumb':
+        sys.stdout.write('\x1b[2J\x1b[H')
+        sys.stdout.flush()
+    else:
+        os.system(_CLEAR_COMMAND)
 
 class Application:
     """The main class responsible for basic user interactions and driving the procedure of the experiment."""
@@ -56,22 +131,103 @@ class Application:
     def __init__(self):
         self.settings = settings.Settings()
         self.settings.load_all_from_ini()
+        _refresh_terminal_width()
+        _install_sigwinch_handler()
+        self._logfile = None
+        self._pending_input = None
+        # log entries are written to disk in the background so the user never waits on I/O
+        self._log_queue = queue.Queue()
+        self._log_error = None
+        self._log_thread = threading.Thread(target=self._log_writer, daemon=True)
+        self._log_thread.start()
+        atexit.register(self._close_logfile)
+
+    def _get_logfile(self, filename):
+        """Return the open logfile, (re)opening it if a different one is needed."""
+        if self._logfile is None or self._logfile.name != filename:
+            if self._logfile is not None:
+                self._logfile.close()
+            # buffered, we flush at the natural boundaries of the session
+            self._logfile = open(filename, 'a', encoding='UTF-8', buffering=_LOGFILE_BUFFER_SIZE)
+        return self._logfile
+
+    def _log_writer(self):
+        """Keep appending queued entries to their logfile, runs in its own thread."""
+        while True:
+            entries = [self._log_queue.get()]
+            # coalesce whatever else has piled up in the meantime
+            try:
+                while True:
+                    entries.append(self._log_queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                for filename, stamp, lines in entries:
+                    self._get_logfile(filename).writelines(stamp + line.strip() + '\n' for line in lines)
+            except Exception as err:  # whatever it is, the thread must live on or join() never returns
+                # reported from the main thread so it doesn't cut into a prompt
+                self._log_error = err
+            finally:
+                for _ in entries:
+                    self._log_queue.task_done()
+
+    def _wait_for_log_writer(self):
+        """Let the writer thread catch up, then report if anything went wrong in the meantime."""
+        self._log_queue.join()
+        err, self._log_error = self._log_error, None
+        if err is not None:
+            print(f"error: could not write to logfile: {err}")
+
+    def _close_logfile(self):
+        """Let go of the logfile, it will be reopened on the next write."""
+        self._wait_for_log_writer()
+        if self._logfile is not None:
+            self._logfile.close()
+            self._logfile = None
+
+    def _flush_logfile(self):
+        """Hand everything logged so far over to the operating system."""
+        self._wait_for_log_writer()
+        if self._logfile is not None:
+            self._logfile.flush()
+
+    def _sync_logfile(self):
+        """Make sure everything logged so far is safely on disk."""
+        self._wait_for_log_writer()
+        if self._logfile is not None:
+            self._logfile.flush()
+            os.fsync(self._logfile.fileno())
+
+    def _report_autosave_error(self):
+        """Tell the user if saving the settings in the background went wrong."""
+        err = self.settings.pop_autosave_error()
+        if err is not None:
+            print(f"error: could not save settings: {err}")
 
     def duplicate_print(self, string, log_only=False):
         """Output the string on the screen and log it in a text file at the same time."""
+        self.duplicate_print_many(string.split('\n'), log_only=log_only)
+
+    def duplicate_print_many(self, lines, log_only=False):
+        """Same as duplicate_print but for a list of lines that need no splitting."""
         if not log_only:
-            print(string)
-        with open(self.settings.logfile_filename, 'a', encoding='UTF-8') as logfile:
-            # prepend timestamp
-            stamped_list = ['[' + str(datetime.datetime.now().replace(microsecond=0)) + '] ' + line.strip() for line in string.split('\n')]
-            stamped_string = '\n'.join(stamped_list)
-            logfile.write(stamped_string + '\n')
+            print('\n'.join(lines))
+        # the same timestamp for every line, the writer thread prepends it
+        stamp = '[' + datetime.datetime.now().isoformat(sep=' ', timespec='seconds') + '] '
+        self._log_queue.put((self.settings.logfile_filename, stamp, tuple(lines)))
 
     def main_menu(self):
         """Show the starting menu screen."""
         my_version = version.get_version()
         print('agl-solitaire ' + my_version + '\n-------------------\n\n(a terminal-based tool for double-blind Artificial Grammar Learning experiments)')
+        menu_actions = {
+            '1': self.run_experiment, 's': self.run_experiment,
+            '2': self.load_grammar,   'r': self.load_grammar,
+            '3': self.save_grammar,   'g': self.save_grammar,
+            '4': self.settings_menu,  'c': self.settings_menu
+        }
         while True:
+            self._report_autosave_error()
             print('\n--------  MAIN MENU  --------')
             print('1: [s]tart new experiment session')
             print('2: [r]epeat experiment with previously used grammar')
@@ -82,18 +238,9 @@ class Application:
             while not choice:
                 choice = input('> ')
             choice = choice[0].lower()
-            if choice in ['1', 's']:
-                self.run_experiment()
-            elif choice in ['2', 'r']:
-                self.load_grammar()
-            elif choice in ['3', 'g']:
-                self.save_grammar()
-            elif choice in ['4', 'c']:
-                self.settings_menu()
-            elif choice in ['0', 'q']:
+            if choice in ['0', 'q']:
                 break
-            else:
-                print('no such option')
+            menu_actions.get(choice, lambda: print('no such option'))()
 
     def generate_grammar(self):
         """Find a grammar that satisfies the protocol's requirements as defined by the user."""
@@ -108,6 +255,9 @@ class Application:
         max_grammar_attempts = 64
         max_oversize_attempts = 5
         oversize_grammar = 0
+        # grammars already found wanting, no point in trying them again
+        seen_grammars = set()
+        max_seen_grammars = 4096
         print('Looking for a suitable random grammar...')
         while num_required_strings != len(grammatical_strings) and oversize_grammar <= max_oversize_attempts:
             grammar_attempts = 0
@@ -116,13 +266,16 @@ class Application:
                 if self.settings.grammar_class == settings.GrammarClass.REGULAR:
                     gmr.randomize(min_states=gmr.MIN_STATES + oversize_grammar,
                                   max_states=gmr.MAX_STATES + oversize_grammar)
-                    gmr.randomize(min_states=gmr.MIN_STATES + oversize_grammar,
-                                  max_states=gmr.MAX_STATES + oversize_grammar)
                 elif self.settings.grammar_class == settings.GrammarClass.PATTERN:
                     # TODO: oversize pattern grammar
                     gmr.randomize()
                 else:
                     assert False
+                grammar_key = repr(gmr)
+                if grammar_key in seen_grammars:
+                    continue
+                if len(seen_grammars) < max_seen_grammars:
+                    seen_grammars.add(grammar_key)
                 if not self.settings.recursion and gmr.has_cycle():
                     continue
                 grammatical_strings = list(gmr.produce_grammatical(num_strings=num_required_strings,
@@ -179,7 +332,7 @@ class Application:
             return
         try:
             gmr = grammar.RegularGrammar.from_obfuscated_repr(settings_and_gmr.grammar)
-        except (IndexError, SyntaxError):
+        except (IndexError, SyntaxError, ValueError):
             print('error: loading grammar from file failed')
             return
         settings_without_gmr = copy.copy(settings_and_gmr)
@@ -200,6 +353,7 @@ class Application:
     def settings_menu(self):
         """Enable user to configure and adjust the experimental protocol."""
         while True:
+            self._report_autosave_error()
             choice = ''
             print('\n--------  SETTINGS  --------')
             print(f" 1: [u]sername (for the record):\t\t{self.settings.username}")
@@ -253,37 +407,44 @@ class Application:
                 new_letters = input('letters to use in strings: ')
                 if not new_letters:
                     print('no letters provided')
-                elif not re.match(r"^\w+$", new_letters):
+                elif not _RE_WORD.match(new_letters):
                     print('error: please type letters only')
-                elif len(set([*new_letters])) < 2:
+                elif len(set(new_letters)) < 2:
                     print('error: at least two different letters required')
                 else:
-                    if re.search(r"\d", new_letters):
+                    if _RE_HAS_DIGIT.search(new_letters):
                         print('warning: using numbers in stimuli is not recommended')
-                    if re.search(r"[A-Z]", new_letters) and re.search(r"[a-z]", new_letters):
+                    if _RE_MIXED_CASE.match(new_letters):
                         print('warning: mixing uppercase and lowercase letters is not recommended')
-                    self.settings.string_letters = sorted(list(set([*new_letters])))
+                    self.settings.string_letters = sorted(set(new_letters))
             elif choice in ['10', 'r']:
                 self.settings.recursion = not self.settings.recursion
             elif choice in ['11', 'f']:
                 new_filename = input('logfile name: ')
-                if os.path.exists(new_filename):
-                    if not os.path.isfile(new_filename):
-                        print('error: not a file (maybe a folder?)')
-                    with open(new_filename, 'r', encoding='UTF-8') as logfile:
-                        first_few_lines = logfile.readlines()[:10]
-                    if not re.search(r'agl-solitaire', '\n'.join(first_few_lines)):
+                try:
+                    file_mode = os.stat(new_filename).st_mode
+                except FileNotFoundError:
+                    file_mode = None
+                if file_mode is None:
+                    while choice not in ['y', 'n']:
+                        choice = input('file does not exist, create it? (y/n)> ')
+                        if choice:
+                            choice = choice[0].lower()
+                elif not stat.S_ISREG(file_mode):
+                    print('error: not a file (maybe a folder?)')
+                    choice = 'n'
+                else:
+                    # the session header is near the top, no need to read the whole log
+                    with open(new_filename, 'r', encoding='UTF-8', errors='replace') as logfile:
+                        beginning = logfile.read(_LOGFILE_PROBE_SIZE)
+                    if not _RE_AGL.search(beginning):
                         print('file does not look like an agl-solitaire log file')
                         while choice not in ['y', 'n']:
                             choice = input('are you sure you want to use this file? (y/n)> ')
                             if choice:
                                 choice = choice[0].lower()
-                else:
-                    while choice not in ['y', 'n']:
-                        choice = input('file does not exist, create it? (y/n)> ')
-                        if choice:
-                            choice = choice[0].lower()
                 if choice in ['11', 'f', 'y']:
+                    self._close_logfile()
                     self.settings.logfile_filename = new_filename
             elif choice in ['12', 'o']:
                 self.settings.training_one_at_a_time = not self.settings.training_one_at_a_time
@@ -296,33 +457,73 @@ class Application:
             if attr_to_change is not None:
                 new_value = input(prompt)
                 try:
-                    if int(new_value) != float(new_value):
-                        raise ValueError('error: please provide an integer')
-                    if int(new_value) < 1:
+                    try:
+                        new_number = int(new_value)
+                    except ValueError:
+                        raise ValueError('error: please provide an integer') from None
+                    if new_number < 1:
                         raise ValueError('error: cannot set less than one')
-                    if (attr_to_change == 'maximum_string_length' and int(new_value) < self.settings.minimum_string_length or
-                        attr_to_change == 'minimum_string_length' and int(new_value) > self.settings.maximum_string_length):
+                    if (attr_to_change == 'maximum_string_length' and new_number < self.settings.minimum_string_length or
+                        attr_to_change == 'minimum_string_length' and new_number > self.settings.maximum_string_length):
                         raise ValueError('error: minimum string length cannot be larger than maximum string length')
                     # this is not normal, but in Python it is
-                    setattr(self.settings, attr_to_change, int(new_value))
+                    setattr(self.settings, attr_to_change, new_number)
                     if (self.settings.training_strings +
                         self.settings.test_strings_grammatical +
                         self.settings.test_strings_ungrammatical) > 100:
                         print('warning: you are advised to keep the total number of training items plus test items under 100')
                 except ValueError as err:
-                    if err:
-                        print(str(err))
-                    else:
-                        print('error: invalid number')
+                    print(str(err))
+
+    def _count_down(self, seconds):
+        """Show a countdown until time is up or the user presses return, whichever comes first."""
+        self._pending_input = None
+        returned = threading.Event()
+        if 'nt' == os.name:
+            # select cannot watch stdin on Windows so we need a helper thread there
+            self._pending_input = threading.Thread(target=self._signal_return, args=(returned,), daemon=True)
+            self._pending_input.start()
+        # a single short line, no need for our wrapping print
+        countdown_template = '\r' + _MARGIN + '%d seconds remaining (press return to finish early)...  '
+        deadline = time.monotonic() + seconds
+        while not returned.is_set():
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                break
+            seconds_shown = math.ceil(remaining_time)
+            sys.stdout.write(countdown_template % seconds_shown)
+            sys.stdout.flush()
+            # sleep until the number shown needs to change, or the user presses return
+            until_next_tick = remaining_time - (seconds_shown - 1)
+            if self._pending_input is None:
+                if select.select([sys.stdin], [], [], until_next_tick)[0]:
+                    input()
+                    returned.set()
+            else:
+                returned.wait(until_next_tick)
+
+    @staticmethod
+    def _signal_return(returned):
+        """Set the event once the user presses return, runs in its own thread."""
+        input()
+        returned.set()
+
+    def _wait_for_return(self):
+        """Wait for the user to press return, or for the press still pending from the countdown."""
+        if self._pending_input is not None and self._pending_input.is_alive():
+            self._pending_input.join()
+        else:
+            input()
+        self._pending_input = None
 
     def run_experiment(self, filename=None, gmr=None):
         """Run one session of training and testing with a random grammar and record everything in the log file."""
-        def clear():
-            if os.system('cls'):
-                # non-zero exit code, try the other command
-                os.system('clear')
         clear()
-        num_required_grammatical = self.settings.training_strings + self.settings.test_strings_grammatical
+        min_length = self.settings.minimum_string_length
+        max_length = self.settings.maximum_string_length
+        training_strings = self.settings.training_strings
+        training_time = self.settings.training_time
+        num_required_grammatical = training_strings + self.settings.test_strings_grammatical
         self.duplicate_print('=' * 120, log_only=True)
         grammatical_strings = None
         if gmr is not None:
@@ -330,8 +531,11 @@ class Application:
             self.duplicate_print(self.settings.pretty_short())
             self.duplicate_print('Generating training strings and test strings based on the grammar...')
             grammatical_strings = list(gmr.produce_grammatical(num_strings=num_required_grammatical,
-                                                               min_length=self.settings.minimum_string_length,
-                                                               max_length=self.settings.maximum_string_length))
+                                                               min_length=min_length,
+                                                               max_length=max_length))
+            if len(grammatical_strings) < num_required_grammatical:
+                self.duplicate_print('error: the grammar does not produce enough strings with the current settings')
+                return
         else:
             self.duplicate_print('agl-solitaire session started with the following settings:')
             self.duplicate_print(self.settings.pretty_print())
@@ -340,13 +544,18 @@ class Application:
                 return
             self.duplicate_print('Generating training strings and test strings based on the grammar...')
         # partition grammatical_strings into two subsets
-        picked_for_training = random.sample(range(0,num_required_grammatical), k=self.settings.training_strings)
-        training_set = [grammatical_strings[i] for i in picked_for_training]
-        test_set = [(grammatical_strings[i], 'y') for i in set(range(0,num_required_grammatical)) - set(picked_for_training)]
-        test_set += [(string, 'n') for string in gmr.produce_ungrammatical(num_strings=self.settings.test_strings_ungrammatical,
-                                                                           min_length=self.settings.minimum_string_length,
-                                                                           max_length=self.settings.maximum_string_length)]
-        assert len(test_set) == self.settings.test_strings_grammatical + self.settings.test_strings_ungrammatical
+        indices = list(range(num_required_grammatical))
+        random.shuffle(indices)
+        training_set = [grammatical_strings[i] for i in indices[:training_strings]]
+        test_set = [(grammatical_strings[i], 'y') for i in indices[training_strings:]]
+        ungrammatical_strings = gmr.produce_ungrammatical(num_strings=self.settings.test_strings_ungrammatical,
+                                                          min_length=min_length,
+                                                          max_length=max_length)
+        if len(ungrammatical_strings) < self.settings.test_strings_ungrammatical:
+            self.duplicate_print('error: the grammar does not leave enough ungrammatical strings with the current settings')
+            return
+        test_set.extend((string, 'n') for string in ungrammatical_strings)
+        num_test = len(test_set)
         # permute test_set
         random.shuffle(test_set)
         self.duplicate_print('Done.')
@@ -362,67 +571,59 @@ class Application:
             self.duplicate_print('What is your profession if you care to share?')
             answer = input()
             self.duplicate_print(answer, log_only=True)
-            self.duplicate_print(f"Out of {len(test_set)} questions what do you expect your score to be in this session?")
+            self.duplicate_print(f"Out of {num_test} questions what do you expect your score to be in this session?")
             answer = input()
             self.duplicate_print(answer, log_only=True)
         self.duplicate_print(f"You may add any {'further ' if self.settings.run_questionnaire else ''}notes or comments for the record before the training phase begins (optional). Please enter an empty line when you're done:")
-        comments = '\n'.join(iter(input, ''))
-        self.duplicate_print(comments, log_only=True)
+        comments = input_lines()
+        self.duplicate_print_many(comments, log_only=True)
+        self._flush_logfile()
         clear()
         if self.settings.training_one_at_a_time:
-            time_per_item = round(float(self.settings.training_time) / self.settings.training_strings, 2)
-            self.duplicate_print(f"The training phase will now begin. You will be presented with {self.settings.training_strings} exemplars of the hidden grammar for {time_per_item} seconds each.")
+            time_per_item = round(float(training_time) / training_strings, 2)
+            self.duplicate_print(f"The training phase will now begin. You will be presented with {training_strings} exemplars of the hidden grammar for {time_per_item} seconds each.")
         else:
-            self.duplicate_print(f"The training phase will now begin. You will have {self.settings.training_time} seconds to study a list of {self.settings.training_strings} exemplars of the hidden grammar.")
+            self.duplicate_print(f"The training phase will now begin. You will have {training_time} seconds to study a list of {training_strings} exemplars of the hidden grammar.")
         self.duplicate_print('Please make sure your screen and terminal font are comfortable to read. Press return when you are ready.')
         input()
-        input_thread = None
         if self.settings.training_one_at_a_time:
             for string in training_set:
                 clear()
                 self.duplicate_print(string)
-                time.sleep(float(self.settings.training_time) / self.settings.training_strings)
+                time.sleep(float(training_time) / training_strings)
         else:
             self.duplicate_print('Training phase started. Please study the following list of strings:')
-            self.duplicate_print('\n'.join(training_set))
+            self.duplicate_print_many(training_set)
             print()
-            input_thread = threading.Thread(target=input, daemon=True)
-            input_thread.start()
-            remaining_time = self.settings.training_time
-            while input_thread.is_alive() and 0 < remaining_time:
-                print(f"\r{remaining_time} seconds remaining (press return to finish early)...  ", end='')
-                time.sleep(1)
-                remaining_time -= 1
-        print('\rTraining phase finished.' + ' ' * 30)
+            self._count_down(training_time)
+        # overwrite the countdown, print() would strip the padding
+        sys.stdout.write('\r' + _MARGIN + 'Training phase finished.' + ' ' * 30 + '\n')
         self.duplicate_print('Training phase finished.', log_only=True)
+        self._sync_logfile()
         clear()
-        self.duplicate_print(f"The test phase will now begin. You will be shown {len(test_set)} new strings one at a time and prompted to judge the grammaticality of each.")
+        self.duplicate_print(f"The test phase will now begin. You will be shown {num_test} new strings one at a time and prompted to judge the grammaticality of each.")
         self.duplicate_print("You may type 'y' for yes (i.e. grammatical) and 'n' for no (ungrammatical). Press return when you are ready.")
-        # recycle input_thread if it's still running...
-        if input_thread and input_thread.is_alive():
-            input_thread.join()
-        else:
-            input()
+        self._wait_for_return()
         # N.B. you can't do the following because you want to update the original test_set
         #for i, item in enumerate(test_set):
-        for i in range(len(test_set)):
+        test_item_prompt = f"Test item #{{}} out of {num_test}. Is the following string grammatical? (y/n)"
+        for i in range(num_test):
             clear()
-            self.duplicate_print(f"Test item #{i+1} out of {len(test_set)}. Is the following string grammatical? (y/n)")
+            self.duplicate_print(test_item_prompt.format(i+1))
             self.duplicate_print(test_set[i][0])
-            answer = '_'
-            while answer[0] not in ['y', 'n']:
-                answer = None
-                while not answer:
-                    answer = input('> ')
-                answer = answer[0].lower()
-                if answer == 'g':
+            while True:
+                answer = input('> ').strip()[:1].lower()
+                if answer in _YES:
                     answer = 'y'
-                elif answer == 'u':
+                    break
+                if answer in _NO:
                     answer = 'n'
+                    break
             self.duplicate_print(answer, log_only=True)
             test_set[i] = (test_set[i][0], test_set[i][1], answer)
         clear()
         self.duplicate_print('Test phase finished. Hope you had fun!')
+        self._sync_logfile()
         if self.settings.run_questionnaire:
             self.duplicate_print('A few more questions if you feel like it:')
             self.duplicate_print('How did you feel during the session?')
@@ -437,16 +638,21 @@ class Application:
         clear()
         self.duplicate_print('And now for the big reveal... Strings were generated using the following regular grammar:')
         self.duplicate_print(str(gmr))
-        correct = sum(item[1] == item[2] for item in test_set)
-        self.duplicate_print(f"You gave {correct} correct answers out of {len(test_set)} ({100 * correct/len(test_set):.3}%). The answers were the following:")
-        # make table columns wider if needed
-        width = max(16, 2 + max(len(item[0]) for item in test_set))
-        self.duplicate_print(f"{'Test string':<{width}}{'Correct answer':<16}{'Your answer':<16}")
-        for item in test_set:
-            self.duplicate_print(f"{item[0]:<{width}}{'yes' if 'y' == item[1] else 'no':<16}{'yes' if 'y' == item[2] else 'no':<16}")
+        correct = 0
+        width = 16
+        for string, correct_answer, answer in test_set:
+            correct += correct_answer == answer
+            # make table columns wider if needed
+            width = max(width, 2 + len(string))
+        self.duplicate_print(f"You gave {correct} correct answers out of {num_test} ({100 * correct/num_test:.3}%). The answers were the following:")
+        table = [f"{'Test string':<{width}}{'Correct answer':<16}{'Your answer':<16}"]
+        table.extend(f"{string:<{width}}{'yes' if 'y' == correct_answer else 'no':<16}{'yes' if 'y' == answer else 'no':<16}"
+                     for string, correct_answer, answer in test_set)
+        self.duplicate_print_many(table)
         self.duplicate_print('You now have a chance to add any other post hoc notes or comments for the record if you wish. Please enter an empty line when you\'re done:')
-        comments = '\n'.join(iter(input, ''))
-        self.duplicate_print(comments, log_only=True)
+        comments = input_lines()
+        self.duplicate_print_many(comments, log_only=True)
+        self._flush_logfile()
 
 
 if __name__ == '__main__':
@@ -1,18 +1,62 @@
 """An implementation of basic regular grammars by way of finite-state automata."""
 
 import abc
+import ast
+import bisect
+import collections
 import enum
+import functools
 import itertools
 import math
+import operator
 import random
-import time
-
-random.seed(time.time())
 
 
 _MIN_STRING_LENGTH = 2
 _MAX_STRING_LENGTH = 8
 _MAX_ATTEMPTS = 10 ** 4
+_MAX_FRUITLESS_ATTEMPTS = 10 ** 3
+
+
+def _obfuscation_shifts(base, modulus):
+    """Yield base ** i % modulus for i = 0, 1, 2... without ever computing the big powers."""
+    shift = 1 % modulus
+    while True:
+        yield shift
+        shift = shift * base % modulus
+
+
+@functools.cache
+def _symbol_bits(symbols):
+    """Give each symbol a bit of its own so that sets of symbols can be handled as ints."""
+    bits = {}
+    for symbol in symbols:
+        bits.setdefault(symbol, 1 << len(bits))
+    return bits
+
+
+class ErrorType(enum.Enum):
+    """List of the different kinds of deviances we can introduce to make a string ungrammatical."""
+    WRONG_FIRST = 1
+    WRONG_SECOND = 2
+    WRONG_PENULTIMATE = 3
+    WRONG_TERMINATION = 4
+    WRONG_INTERNAL = 5
+    BACKWARDS = 6
+    RANDOM = 7  # arbitrary UG string made up of the given symbols; not in the original paper
+
+_ERROR_PROPORTIONS = {
+    ErrorType.WRONG_FIRST : 5,
+    ErrorType.WRONG_SECOND : 5,
+    ErrorType.WRONG_PENULTIMATE : 5,
+    ErrorType.WRONG_TERMINATION : 5,
+    ErrorType.WRONG_INTERNAL : 2,
+    ErrorType.BACKWARDS : 3,
+    ErrorType.RANDOM : 5
+}
+_ERROR_TYPES = list(_ERROR_PROPORTIONS)
+_ERROR_WEIGHTS = list(_ERROR_PROPORTIONS.values())
+_RANDOM_ONLY_WEIGHTS = [int(ErrorType.RANDOM == kind) for kind in _ERROR_TYPES]
 
 
 class Grammar(abc.ABC):
@@ -38,39 +82,44 @@ class Grammar(abc.ABC):
         """Decide whether the input string conforms to the grammar."""
         raise NotImplementedError
 
-    def produce_ungrammatical(self, num_strings=1, min_length=_MIN_STRING_LENGTH, max_length=_MAX_STRING_LENGTH):
-        """Generate unacceptable strings loosely following Reber & Allen 1978's procedure."""
-        class ErrorType(enum.Enum):
-            """List of the different kinds of deviances we can introduce to make a string ungrammatical."""
-            WRONG_FIRST = 1
-            WRONG_SECOND = 2
-            WRONG_PENULTIMATE = 3
-            WRONG_TERMINATION = 4
-            WRONG_INTERNAL = 5
-            BACKWARDS = 6
-            RANDOM = 7  # arbitrary UG string made up of the given symbols; not in the original paper
-        error_proportions = {
-            ErrorType.WRONG_FIRST : 5,
-            ErrorType.WRONG_SECOND : 5,
-            ErrorType.WRONG_PENULTIMATE : 5,
-            ErrorType.WRONG_TERMINATION : 5,
-            ErrorType.WRONG_INTERNAL : 2,
-            ErrorType.BACKWARDS : 3,
-            ErrorType.RANDOM : 5
-        }
+    def produce_ungrammatical(self, num_strings=1, min_length=_MIN_STRING_LENGTH, max_length=_MAX_STRING_LENGTH, max_attempts=_MAX_ATTEMPTS):
+        """Generate unacceptable strings loosely following Reber & Allen 1978's procedure.
+        Might return fewer than num_strings if the grammar accepts nearly everything."""
         ungrammatical_strings = set()
-        while len(ungrammatical_strings) < num_strings:
+        symbols = self.symbols
+        # for each symbol, the ones it can be swapped for
+        other_symbols = {symbol: tuple(other for other in symbols if other != symbol) for symbol in symbols}
+        produce_grammatical = self.produce_grammatical
+        recognize = self.recognize
+        error_types = _ERROR_TYPES
+        error_weights = _ERROR_WEIGHTS
+        planned_error_types = iter(())
+        attempts = 0
+        last_new_string_at = 0
+        while len(ungrammatical_strings) < num_strings and attempts < max_attempts:
+            attempts += 1
+            if attempts - last_new_string_at == _MAX_FRUITLESS_ATTEMPTS:
+                # mangling grammatical strings keeps yielding nothing new, try an arbitrary string instead
+                error_weights = _RANDOM_ONLY_WEIGHTS
+                planned_error_types = iter(())
             string = ''
-            # pick a random way to create an ungrammatical string
-            error_type = random.choices(list(ErrorType), weights=error_proportions.values())[0]
-            grammatical_string = self.produce_grammatical(1, min_length=min_length, max_length=max_length).pop()
+            # pick a random way to create an ungrammatical string, drawn in batches
+            error_type = next(planned_error_types, None)
+            if error_type is None:
+                planned_error_types = iter(self._rng.choices(error_types, weights=error_weights, k=4 * num_strings))
+                error_type = next(planned_error_types)
+            if error_type != ErrorType.RANDOM:
+                grammatical_strings = produce_grammatical(1, min_length=min_length, max_length=max_length)
+                if not grammatical_strings:
+                    continue  # nothing to mangle in this length range, nevermind
+                grammatical_string = grammatical_strings.pop()
             if error_type == ErrorType.RANDOM:
                 # arbitrary mangled string
-                string_length = random.randint(min_length, max_length)
-                string = ''.join(random.choice(self.symbols) for _ in range(string_length))
+                string_length = self._rng.randint(min_length, max_length)
+                string = ''.join(self._rng.choices(symbols, k=string_length))
             elif error_type == ErrorType.BACKWARDS:
                 # a grammatical string mirrored i.e. spelled backwards
-                string = ''.join(reversed(grammatical_string))
+                string = grammatical_string[::-1]
             elif error_type == ErrorType.WRONG_TERMINATION:
                 # chop the final symbol off a correct string
                 if len(grammatical_string) < min_length + 1:
@@ -84,21 +133,31 @@ class Grammar(abc.ABC):
                 elif error_type == ErrorType.WRONG_SECOND:
                     wrong_index = 1
                 elif error_type == ErrorType.WRONG_PENULTIMATE:
-                    wrong_index = len(string) - 2
+                    wrong_index = len(grammatical_string) - 2
                 elif error_type == ErrorType.WRONG_INTERNAL:
                     try:
-                        wrong_index = random.randint(2, len(grammatical_string) - 3)
+                        wrong_index = self._rng.randint(2, len(grammatical_string) - 3)
                     except ValueError:
                         continue  # string not long enough, nevermind
                 else:
                     assert False
-                wrong_symbol = random.choice(self.symbols)
-                while wrong_symbol == grammatical_string[wrong_index]:
-                    wrong_symbol = random.choice(self.symbols)
+                wrong_symbol = grammatical_string[wrong_index]
+                replacements = other_symbols.get(wrong_symbol)
+                if replacements is None:
+                    # a letter we weren't given (e.g. in a predefined grammar), any of ours will do
+                    replacements = other_symbols[wrong_symbol] = tuple(other for other in symbols if other != wrong_symbol)
+                if not replacements:
+                    continue  # nothing to swap this symbol for, nevermind
+                wrong_symbol = self._rng.choice(replacements)
                 string = grammatical_string[:wrong_index] + wrong_symbol + grammatical_string[wrong_index+1:]
             # make sure we didn't get another grammatical string by accident
-            if not self.recognize(string) and min_length <= len(string) <= max_length:
+            if not recognize(string) and min_length <= len(string) <= max_length and string not in ungrammatical_strings:
                 ungrammatical_strings.add(string)
+                last_new_string_at = attempts
+                if error_weights is _RANDOM_ONLY_WEIGHTS:
+                    # only this one string needed the fallback, back to the usual mix for the next
+                    error_weights = _ERROR_WEIGHTS
+                    planned_error_types = iter(())
         return ungrammatical_strings
 
 
@@ -117,12 +176,40 @@ class RegularGrammar(Grammar):
     MAX_STATES = 7
     MIN_PATH_LENGTH = 2
 
-    def __init__(self, symbols=None):
+    def __init__(self, symbols=None, seed=None):
         self.symbols = symbols
         if not symbols:
             self.symbols = ['M', 'R', 'S', 'V', 'X']
+        # a generator of our own keeps sampling reproducible for a given seed
+        self._rng = random.Random(seed)
         self.transitions = []
 
+    @property
+    def transitions(self):
+        """The edges of the state graph. Assign a new list to change them, don't edit it in place,
+        otherwise the lookup tables derived from it go stale."""
+        return self._transitions
+
+    @transitions.setter
+    def transitions(self, transitions):
+        self._transitions = transitions
+        # rebuilt on demand
+        self._next_states = None
+        self._accepting_states = None
+        self._edge_symbols = None
+        self._edge_targets = None
+        self._edge_weights_by_range = {}
+
+    def _build_tables(self):
+        """Derive the lookup tables the producer and the recognizer use from the current transitions."""
+        # the edges of each state as two parallel tuples for picking one at random
+        self._edge_symbols = [tuple(state) for state in self._transitions]
+        self._edge_targets = [tuple(state.values()) for state in self._transitions]
+        # leave out the exits so that a None from .get() can only mean there is no such edge
+        self._next_states = [{symbol: target for symbol, target in state.items() if symbol is not None}
+                             for state in self._transitions]
+        self._accepting_states = frozenset(i for i, state in enumerate(self._transitions) if None in state)
+
     def __repr__(self):
         return str(self.transitions)
 
@@ -131,32 +218,29 @@ class RegularGrammar(Grammar):
         repr_string = self.__repr__()
         coprimes = (2, 2)
         while 1 != math.gcd(*coprimes):
-            coprimes = sorted((random.randrange(95), random.randrange(95)))
-        obfuscated_repr_string = ''
-        for i, char in enumerate(repr_string):
-            # use the ASCII range [32, 126] only
-            obfuscated_repr_string += chr(32 + (ord(char) - 32 + coprimes[0] ** i % coprimes[1]) % 95)
+            coprimes = sorted((self._rng.randrange(95), self._rng.randrange(95)))
+        # use the ASCII range [32, 126] only
+        obfuscated_repr_string = ''.join(chr(32 + (ord(char) - 32 + shift) % 95)
+                                         for char, shift in zip(repr_string, _obfuscation_shifts(*coprimes)))
         return chr(32 + coprimes[0]) + chr(32 + coprimes[1]) + obfuscated_repr_string
 
     @classmethod
     def from_repr(cls, repr_string):
         """Restore Grammar from string representation."""
         grammar = cls()
-        grammar.transitions = eval(repr_string)
+        grammar.transitions = ast.literal_eval(repr_string)
         return grammar
 
     @classmethod
     def from_obfuscated_repr(cls, obfuscated_repr_string):
         """Restore Grammar from obfuscated string representation."""
-        repr_string = ''
         coprimes = (ord(obfuscated_repr_string[0]) - 32,
                     ord(obfuscated_repr_string[1]) - 32)
         obfuscated_repr_string = obfuscated_repr_string[2:]
-        repr_string = ''
-        for i, char in enumerate(obfuscated_repr_string):
-            repr_string += chr(32 + (ord(char) - 32 - coprimes[0] ** i % coprimes[1]) % 95)
+        repr_string = ''.join(chr(32 + (ord(char) - 32 - shift) % 95)
+                              for char, shift in zip(obfuscated_repr_string, _obfuscation_shifts(*coprimes)))
         grammar = cls()
-        grammar.transitions = eval(repr_string)
+        grammar.transitions = ast.literal_eval(repr_string)
         return grammar
 
     def __str__(self):
@@ -172,117 +256,223 @@ class RegularGrammar(Grammar):
             min_states=RegularGrammar.MIN_STATES
         if max_states is None:
             max_states=RegularGrammar.MAX_STATES
+        rng = self._rng
+        symbol_choices = self.symbols + [None]
         acceptable = False
         while not acceptable:
-            self.transitions = []
-            num_states = random.randint(min_states, max_states)
-            for _ in range(num_states):
-                self.transitions.append({})
-                num_transitions = random.randint(0, num_states)
-                for _ in range(min(num_transitions, len(self.symbols))):  # avoid inf loop if all symbols are already used up
-                    # allow accidentally overwriting a previous entry, that's fine
-                    symbol = random.choice(self.symbols + [None])
-                    new_state = None
-                    if symbol is not None:
-                        new_state = random.randrange(num_states)
-                        # no more than one edge between the same states
-                        while new_state in self.transitions[-1].values():
-                            new_state = random.randrange(num_states)
-                    self.transitions[-1][symbol] = new_state
-            # fix trap states after the fact
-            for state in self.transitions:
-                if not state:
-                    state[None] = None
+            num_states = rng.randint(min_states, max_states)
+            first_edges = self._random_edges(num_states, symbol_choices)
+            if None in first_edges:
+                continue  # exit right at the start, no use building the rest
+            transitions = [first_edges] + [self._random_edges(num_states, symbol_choices) for _ in range(num_states - 1)]
+            self.transitions = transitions
             # make sure...
             # 1. the graph we got is connected
             # 2. there is at least one exit
             # 3. the exit is reachable (in no fewer than MIN_PATH_LENGTH steps)
             # 4. there is no dead cycle in the graph
-            acceptable = (self.is_connected() and
-                          any(None in s for s in self.transitions) and
-                          RegularGrammar.MIN_PATH_LENGTH <= self.shortest_path_through() < math.inf and
-                          not self.has_dead_cycle())
+            acceptable = self._is_acceptable()
+
+    def _random_edges(self, num_states, symbol_choices):
+        """Pick the outgoing edges of a single state for randomize."""
+        rng = self._rng
+        edges = {}
+        targets = set()
+        num_transitions = rng.randint(0, num_states)
+        for _ in range(min(num_transitions, len(self.symbols))):  # avoid inf loop if all symbols are already used up
+            # allow accidentally overwriting a previous entry, that's fine
+            symbol = rng.choice(symbol_choices)
+            new_state = None
+            if symbol is not None:
+                new_state = rng.randrange(num_states)
+                # no more than one edge between the same states
+                while new_state in targets:
+                    new_state = rng.randrange(num_states)
+            targets.discard(edges.get(symbol))
+            targets.add(new_state)
+            edges[symbol] = new_state
+        # fix trap states after the fact
+        if not edges:
+            edges[None] = None
+        return edges
 
     def is_connected(self):
         """Check if the state graph is made up of a single component."""
-        visited = set([0])
-        while True:
-            visited_new = visited | set(itertools.chain.from_iterable(self.transitions[s].values() for s in visited))
-            visited_new -= {None}
-            if visited == visited_new:
-                break
-            visited = visited_new
-        return visited == set(range(len(self.transitions)))
+        # sets of states as bits of an int, the graph is small enough
+        successors = [sum(1 << state for state in set(edges.values()) if state is not None)
+                      for edges in self.transitions]
+        visited = frontier = 1
+        while frontier:
+            reached = 0
+            for state, state_successors in enumerate(successors):
+                if frontier >> state & 1:
+                    reached |= state_successors
+            frontier = reached & ~visited
+            visited |= frontier
+        return visited == (1 << len(self.transitions)) - 1
 
     def has_cycle(self):
         """Determine if the graph includes a directed cycle."""
         # make sure we have no trap states (dead ends) left
         assert all(self.transitions)
-        # depth-first search
-        def dfs(state, path):
-            if state is None:
-                return False
-            if state in path:
-                return True
-            return any(dfs(edge, path.union(set({state}))) for edge in self.transitions[state].values())
-        return dfs(0, set())
+        # depth-first search, a cycle shows up as an edge back into the current path
+        ON_PATH, DONE = 1, 2
+        status = bytearray(len(self.transitions))  # all zeros, i.e. unseen
+        status[0] = ON_PATH
+        stack = [(0, iter(self.transitions[0].values()))]
+        while stack:
+            state, edges = stack[-1]
+            for next_state in edges:
+                if next_state is None or DONE == status[next_state]:
+                    continue
+                if ON_PATH == status[next_state]:
+                    return True
+                status[next_state] = ON_PATH
+                stack.append((next_state, iter(self.transitions[next_state].values())))
+                break
+            else:
+                # every edge out of this state has been followed
+                status[state] = DONE
+                stack.pop()
+        return False
 
     def shortest_path_through(self, starting_state=0):
         """Calculate how many steps it takes to speedrun the graph to an accepting state."""
-        # basically a Dijkstra
-        def descend(state, visited):
+        # breadth-first search, the first accepting state we meet is the closest one
+        distances = {starting_state: 0}
+        queue = collections.deque([starting_state])
+        while queue:
+            state = queue.popleft()
             if None in self.transitions[state]:
-                return 0
-            visited.add(state)
-            reachable_states = set(self.transitions[state].values()) - visited
-            if not reachable_states:
-                return math.inf
-            return 1 + min(map(lambda s: descend(s, visited), reachable_states))
-        return descend(starting_state, set())
+                return distances[state]
+            for next_state in self.transitions[state].values():
+                if next_state not in distances:
+                    distances[next_state] = distances[state] + 1
+                    queue.append(next_state)
+        return math.inf
 
     def has_dead_cycle(self):
         """Determine if the graph contains a cycle that cannot be escaped."""
-        return any(self.shortest_path_through(s) == math.inf for s in range(len(self.transitions)))
+        predecessors = [[] for _ in self.transitions]
+        for state, edges in enumerate(self.transitions):
+            for next_state in edges.values():
+                if next_state is not None:
+                    predecessors[next_state].append(state)
+        return self._count_escapable_states(predecessors) < len(self.transitions)
+
+    def _count_escapable_states(self, predecessors):
+        """Walk the edges backwards from the accepting states, every state left out is a trap."""
+        can_exit = {state for state, edges in enumerate(self.transitions) if None in edges}
+        queue = collections.deque(can_exit)
+        while queue:
+            for previous_state in predecessors[queue.popleft()]:
+                if previous_state not in can_exit:
+                    can_exit.add(previous_state)
+                    queue.append(previous_state)
+        return len(can_exit)
+
+    def _is_acceptable(self):
+        """The checks randomize needs, done in a single pass over the graph and a single pass
+        back: see is_connected, shortest_path_through and has_dead_cycle."""
+        transitions = self.transitions
+        predecessors = [[] for _ in transitions]
+        # breadth-first from the start, noting the first exit on the way
+        distances = {0: 0}
+        exit_distance = math.inf
+        queue = collections.deque([0])
+        while queue:
+            state = queue.popleft()
+            if None in transitions[state] and math.inf == exit_distance:
+                exit_distance = distances[state]
+            for next_state in transitions[state].values():
+                if next_state is None:
+                    continue
+                predecessors[next_state].append(state)
+                if next_state not in distances:
+                    distances[next_state] = distances[state] + 1
+                    queue.append(next_state)
+        if len(distances) < len(transitions):
+            return False  # not connected
+        if not RegularGrammar.MIN_PATH_LENGTH <= exit_distance < math.inf:
+            return False
+        # every state has been visited so the predecessor lists are complete
+        return self._count_escapable_states(predecessors) == len(transitions)
 
     def produce_grammatical(self, num_strings=1, min_length=_MIN_STRING_LENGTH, max_length=_MAX_STRING_LENGTH, max_attempts=_MAX_ATTEMPTS):
         """Follow the given grammar to output grammatical strings."""
         assert 0 < len(self.transitions)
         grammatical_strings = set()
+        if self._edge_symbols is None:
+            self._build_tables()
+        symbol_table = self._edge_symbols
+        target_table = self._edge_targets
+        edge_weights = self._edge_weights(min_length, max_length)
+        if not edge_weights or 0 == edge_weights[0][0][-1]:
+            return grammatical_strings  # no string in the length range at all
+        uniform = self._rng.random
+        find_edge = bisect.bisect
         # there might not exist num_strings different output strings in the length range
         attempts = 0
-        while len(grammatical_strings) < num_strings and attempts < max_attempts:
-            string = ''
-            # keep trying until we get the string length right
-            while not min_length <= len(string) <= max_length and attempts < max_attempts:
-                string = ''
-                current_state = 0
-                while len(string) < max_length and current_state is not None:
-                    # pick a random edge
-                    available_symbols = list(self.transitions[current_state])
-                    next_symbol = random.choice(available_symbols)
-                    if next_symbol is not None:
-                        string += next_symbol
-                    # follow the edge to the next state
-                    current_state = self.transitions[current_state][next_symbol]
-                attempts += 1
-            # did we end up in a halting state?
-            if current_state is None:
+        last_new_string_at = 0
+        while (len(grammatical_strings) < num_strings and attempts < max_attempts and
+               attempts - last_new_string_at < _MAX_FRUITLESS_ATTEMPTS):
+            attempts += 1
+            symbols = []
+            current_state = 0
+            while current_state is not None:
+                # pick a random edge that still allows for an acceptable string length
+                weights = edge_weights[len(symbols)][current_state]
+                edge = find_edge(weights, uniform() * weights[-1])
+                next_symbol = symbol_table[current_state][edge]
+                if next_symbol is not None:
+                    symbols.append(next_symbol)
+                # follow the edge to the next state
+                current_state = target_table[current_state][edge]
+            string = ''.join(symbols)
+            if string not in grammatical_strings:
                 grammatical_strings.add(string)
+                last_new_string_at = attempts
         return grammatical_strings
 
+    def _edge_weights(self, min_length, max_length):
+        """Cumulative weights for the edges of each state at each string length so far, proportional
+        to the chance that a random walk taking that edge exits with an acceptable length. Picking
+        edges by these weights yields the same strings as walking at random and throwing away
+        the misfits, only without the throwing away."""
+        # produce_ungrammatical keeps asking for the same range one string at a time
+        try:
+            return self._edge_weights_by_range[(min_length, max_length)]
+        except KeyError:
+            pass
+        num_states = len(self._transitions)
+        # success[length][state]: the chance that a walk in this state with length symbols
+        # so far goes on to exit with a length in range
+        success = [[0.0] * num_states for _ in range(max_length + 2)]
+        edge_weights = [None] * (max_length + 1)
+        for length in range(max_length, -1, -1):
+            exit_weight = 1.0 if min_length <= length else 0.0
+            edge_weights[length] = []
+            for state in range(num_states):
+                weights = [exit_weight if target is None else success[length + 1][target]
+                           for target in self._edge_targets[state]]
+                success[length][state] = sum(weights) / len(weights)
+                edge_weights[length].append(list(itertools.accumulate(weights)))
+        self._edge_weights_by_range[(min_length, max_length)] = edge_weights
+        return edge_weights
+
     def recognize(self, string):
         """Decide whether the input string conforms to the given grammar."""
         assert 0 < len(self.transitions)
+        if self._next_states is None:
+            self._build_tables()
+        next_states = self._next_states
         state = 0
-        while string:
-            head = string[0]
-            string = string[1:]
-            try:
-                state = self.transitions[state][head]
-            except KeyError:
+        for symbol in string:
+            state = next_states[state].get(symbol)
+            if state is None:
                 return False
         # can we legally exit from the final state?
-        return None in self.transitions[state]
+        return state in self._accepting_states
 
 
 # a few example finite state grammars from classic AGL papers
@@ -358,13 +548,39 @@ class PatternGrammar(Grammar):
     MIN_LENGTH = 2
     MAX_LENGTH = 8
 
-    def __init__(self, symbols=None):
+    def __init__(self, symbols=None, seed=None):
         self.symbols = symbols
         if not symbols:
             self.symbols = ['M', 'R', 'S', 'V', 'X']
+        # a generator of our own keeps sampling reproducible for a given seed
+        self._rng = random.Random(seed)
         self.classes = []
         self.patterns = []
 
+    @property
+    def patterns(self):
+        """The sequences of classes that make up the grammar. Assign a new list to change them,
+        don't edit it in place, otherwise the tables derived from it go stale."""
+        return self._patterns
+
+    @patterns.setter
+    def patterns(self, patterns):
+        self._patterns = patterns
+        self._pattern_tuples_by_range = {}
+        self._patterns_by_length = None
+
+    def _pattern_tuples(self, min_length, max_length):
+        """The patterns in the length range with each class as a sorted tuple: cheaper to pick
+        from than a set and in the same order on every run."""
+        try:
+            return self._pattern_tuples_by_range[(min_length, max_length)]
+        except KeyError:
+            pass
+        pattern_tuples = [tuple(tuple(sorted(cls)) for cls in pattern)
+                          for pattern in self._patterns if min_length <= len(pattern) <= max_length]
+        self._pattern_tuples_by_range[(min_length, max_length)] = pattern_tuples
+        return pattern_tuples
+
     def obfuscated_repr(self):
         """A marshalled representation of the grammar made unreadable for repeat experiments."""
         # TODO
@@ -402,29 +618,41 @@ class PatternGrammar(Grammar):
         self.patterns = []
         while not self.classes_okay():
             # partition set of symbols randomly
-            self.classes = [set() for _ in range(random.randint(min_classes, max_classes))]
+            self.classes = [set() for _ in range(self._rng.randint(min_classes, max_classes))]
             for symbol in self.symbols:
                 # random.choice here?
-                self.classes[random.randrange(len(self.classes))].add(symbol)
+                self.classes[self._rng.randrange(len(self.classes))].add(symbol)
             for cls in self.classes:
                 if not cls:
-                    cls.add(random.choice(self.symbols))
-        self.patterns = [[] for _ in range(random.randint(min_patterns, max_patterns))]
+                    cls.add(self._rng.choice(self.symbols))
+        self.patterns = [[] for _ in range(self._rng.randint(min_patterns, max_patterns))]
         for pattern in self.patterns:
-            for _ in range(random.randint(min_length, max_length)):
-                pattern.append(random.choice(self.classes))
+            for _ in range(self._rng.randint(min_length, max_length)):
+                pattern.append(self._rng.choice(self.classes))
 
     def classes_okay(self):
         """Verify that current classes aren't trivial, include all symbols and do not overlap."""
         # not all classes singletons?
         if all(len(c) == 1 for c in self.classes):
             return False
+        # classes as bits of an int, one bit per symbol
+        bits = _symbol_bits(tuple(self.symbols))
+        masks = []
+        for c in self.classes:
+            mask = 0
+            for symbol in c:
+                bit = bits.get(symbol)
+                if bit is None:
+                    return False  # a symbol we weren't given
+                mask |= bit
+            masks.append(mask)
         # all symbols covered?
-        if set().union(*self.classes) != set(self.symbols):
+        if functools.reduce(operator.or_, masks, 0) != (1 << len(bits)) - 1:
             return False
-        # no overlaps between classes?
-        for c1, c2 in itertools.combinations(self.classes, 2):
-            if not c1.isdisjoint(c2) and c1.union(c2) - c2 and c2.union(c1) - c1:
+        # no overlaps between classes, unless one contains the other?
+        for m1, m2 in itertools.combinations(masks, 2):
+            common = m1 & m2
+            if common and common != m1 and common != m2:
                 return False
         return True
 
@@ -443,19 +671,31 @@ class PatternGrammar(Grammar):
         assert 0 < len(self.classes)
         assert 0 < len(self.patterns)
         grammatical_strings = set()
-        suitable_patterns = list(filter(lambda t: min_length <= len(t) <= max_length, self.patterns))
+        # produce_ungrammatical keeps asking for the same range one string at a time
+        suitable_patterns = self._pattern_tuples(min_length, max_length)
         if not suitable_patterns:
             return set()
+        choice = self._rng.choice
         # there might not exist num_strings different output strings in the length range
         attempts = 0
-        while len(grammatical_strings) < num_strings and attempts < max_attempts:
-            pattern = random.choice(suitable_patterns)
-            string = ''.join(map(lambda c: random.choice(list(c)), pattern))
-            grammatical_strings.add(string)
+        last_new_string_at = 0
+        while (len(grammatical_strings) < num_strings and attempts < max_attempts and
+               attempts - last_new_string_at < _MAX_FRUITLESS_ATTEMPTS):
+            attempts += 1
+            pattern = choice(suitable_patterns)
+            string = ''.join([choice(cls) for cls in pattern])
+            if string not in grammatical_strings:
+                grammatical_strings.add(string)
+                last_new_string_at = attempts
         return grammatical_strings
 
     def recognize(self, string):
         """Decide whether the grammar has a pattern matching the input string."""
+        if self._patterns_by_length is None:
+            # a string can only match a pattern of its own length
+            self._patterns_by_length = {}
+            for pattern in self._patterns:
+                self._patterns_by_length.setdefault(len(pattern), []).append(tuple(map(frozenset, pattern)))
         def matches(string, pattern):
             return all(char in cls for char, cls in zip(string, pattern))
-        return any(matches(string, pattern) for pattern in self.patterns)
+        return any(matches(string, pattern) for pattern in self._patterns_by_length.get(len(string), ()))
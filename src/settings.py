@@ -1,18 +1,55 @@
 """Save, load and configure persistent user preferences for the AGL experiment paradigm."""
 
+import atexit
 import configparser
 import dataclasses
 import enum
+import io
+import os
 try:
     import tomllib
     _TOMLLIB_AVAILABLE = True
 except ImportError:
     _TOMLLIB_AVAILABLE = False
+import threading
+import time
 import typing
+import weakref
 
 
 _DEFAULT_INI_FILENAME  = 'settings.ini'
 _DEFAULT_TOML_FILENAME = 'settings.toml'
+_AUTOSAVE_DELAY = 0.2  # seconds
+# configparser will try to interpolate the string and cry
+# if it has a stray % character so we must escape those
+_INI_ESCAPES = str.maketrans({'%': '%%'})
+_TOML_ESCAPES = str.maketrans({'\\': r'\\', '"': r'\"'})
+_AUTOSAVE_LOCK = threading.Lock()
+# settings objects with a save still to come, weakly held so they can be let go
+_PENDING_AUTOSAVES = weakref.WeakValueDictionary()
+_TRUE_STRINGS = frozenset(('true', 'yes', '1'))
+
+
+def _write_atomically(filename, text):
+    """Replace the file's contents in one go so that an interrupted save can't leave it half written."""
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w', encoding='UTF-8') as file:
+        file.write(text)
+    os.replace(temp_filename, filename)
+
+
+def _parse_bool(value):
+    """Read a boolean setting, bool('False') would be True."""
+    if isinstance(value, bool):
+        return value  # TOML has real booleans
+    return str(value).lower() in _TRUE_STRINGS
+
+# how to read a value loaded from file for each kind of field, the rest are cast to their type
+_PARSERS_BY_TYPE = {
+    bool: _parse_bool,
+    list[str]: list,
+    typing.Optional[str]: str,
+}
 
 
 class GrammarClass(enum.StrEnum):
@@ -41,57 +78,46 @@ class Settings:
 
     def __str__(self):
         """Print all settings in an .ini config file format."""
-        str_repr = ''
-        for field in dataclasses.fields(self):
-            str_repr += f"{field.name}: {getattr(self, field.name)}\n"
-        return str_repr
+        return ''.join([f"{name}: {getattr(self, name)}\n" for name in _FIELD_NAMES])
 
     def pretty_print(self):
         """Print all settings in an even more conveniently readable format."""
-        pretty = ''
-        pretty += f"Username: {self.username}\n"
-        pretty += f"Grammar class: {self.grammar_class}\n"
-        pretty += f"Number of training strings: {self.training_strings}\n"
-        pretty += f"Time allotted for training: {self.training_time}\n"
-        pretty += f"Number of grammatical test strings: {self.test_strings_grammatical}\n"
-        pretty += f"Number of ungrammatical test strings: {self.test_strings_ungrammatical}\n"
-        pretty += f"Minimum string length: {self.minimum_string_length}\n"
-        pretty += f"Maximum string length: {self.maximum_string_length}\n"
-        pretty += f"Letters to use in strings: {self.string_letters}\n"
-        pretty += f"Recursion allowed in grammar: {self.recursion}\n"
-        pretty += f"Logfile to record session in: {self.logfile_filename}\n"
-        pretty += f"Show training strings one at a time: {self.training_one_at_a_time}\n"
-        pretty += f"Run pre and post session questionnaire: {self.run_questionnaire}\n"
-        return pretty
+        return '\n'.join([
+            f"Username: {self.username}",
+            f"Grammar class: {self.grammar_class}",
+            f"Number of training strings: {self.training_strings}",
+            f"Time allotted for training: {self.training_time}",
+            f"Number of grammatical test strings: {self.test_strings_grammatical}",
+            f"Number of ungrammatical test strings: {self.test_strings_ungrammatical}",
+            f"Minimum string length: {self.minimum_string_length}",
+            f"Maximum string length: {self.maximum_string_length}",
+            f"Letters to use in strings: {self.string_letters}",
+            f"Recursion allowed in grammar: {self.recursion}",
+            f"Logfile to record session in: {self.logfile_filename}",
+            f"Show training strings one at a time: {self.training_one_at_a_time}",
+            f"Run pre and post session questionnaire: {self.run_questionnaire}",
+        ]) + '\n'
 
     def pretty_short(self):
         """Only print settings relevant with a grammar loaded from file."""
-        pretty = ''
-        pretty += f"Username: {self.username}\n"
-        pretty += f"Number of training strings: {self.training_strings}\n"
-        pretty += f"Time allotted for training: {self.training_time}\n"
-        pretty += f"Number of grammatical test strings: {self.test_strings_grammatical}\n"
-        pretty += f"Number of ungrammatical test strings: {self.test_strings_ungrammatical}\n"
-        pretty += f"Logfile to record session in: {self.logfile_filename}\n"
-        pretty += f"Show training strings one at a time: {self.training_one_at_a_time}\n"
-        pretty += f"Run pre and post session questionnaire: {self.run_questionnaire}\n"
-        return pretty
+        return '\n'.join([
+            f"Username: {self.username}",
+            f"Number of training strings: {self.training_strings}",
+            f"Time allotted for training: {self.training_time}",
+            f"Number of grammatical test strings: {self.test_strings_grammatical}",
+            f"Number of ungrammatical test strings: {self.test_strings_ungrammatical}",
+            f"Logfile to record session in: {self.logfile_filename}",
+            f"Show training strings one at a time: {self.training_one_at_a_time}",
+            f"Run pre and post session questionnaire: {self.run_questionnaire}",
+        ]) + '\n'
 
     def process_loaded_entry(self, attr_name, value):
         """Helper method to set a specific member variable based on the value
         loaded from file."""
-        try:
-            # parse attribute from string
-            parsed_value = type(getattr(self, attr_name))(value)
-            if attr_name in ['recursion', 'training_one_at_a_time', 'run_questionnaire']:
-                parsed_value = str(value).lower() in ['true', 'yes', '1']
-            setattr(self, attr_name, parsed_value)
-        except TypeError:
-            # current grammar is None which you cannot cast to
-            assert getattr(self, attr_name) is None
-            self.grammar = value
-        except AttributeError:
-            pass  # doesn't matter
+        parse = _FIELD_PARSERS.get(attr_name)
+        if parse is None:
+            return  # doesn't matter
+        setattr(self, attr_name, parse(value))
 
     def load_all(self, filename):
         """Read and set our settings values from file according to format based on its extension."""
@@ -104,6 +130,8 @@ class Settings:
 
     def load_all_from_ini(self, filename=_DEFAULT_INI_FILENAME):
         """Read and set our settings values from an INI settings file if it exists."""
+        # don't save after every single entry that we're reading in anyway
+        self.autosave = False
         config = configparser.ConfigParser()
         config.read(filename)
         for section in config:
@@ -119,61 +147,131 @@ class Settings:
                     settings_dict = tomllib.load(file)
             except FileNotFoundError:
                 return  # alright
-            for key in settings_dict:
-                if type(settings_dict[key]) is dict:
-                    for subkey in settings_dict[key]:
-                        self.process_loaded_entry(subkey, settings_dict[key][subkey])
+            self.autosave = False
+            for key, value in settings_dict.items():
+                # entries may or may not be grouped in tables
+                if isinstance(value, dict):
+                    for subkey, subvalue in value.items():
+                        self.process_loaded_entry(subkey, subvalue)
                 else:
-                    self.process_loaded_entry(key, settings_dict[key])
+                    self.process_loaded_entry(key, value)
             self.autosave = True
 
     def save_all_to_ini(self, filename=_DEFAULT_INI_FILENAME):
         """Write the current values of all our member variables to an INI config file."""
         config = configparser.ConfigParser()
-        for field in dataclasses.fields(self):
-            if 'grammar' == field.name and self.grammar is None:
+        for name in _FIELD_NAMES:
+            if 'grammar' == name and self.grammar is None:
                 continue
             # the string_letters variable is a list of strings internally
-            if 'string_letters' == field.name:
-                config['DEFAULT'][field.name] = ''.join(self.string_letters)
+            if 'string_letters' == name:
+                config['DEFAULT'][name] = ''.join(self.string_letters)
             else:
-                # configparser will try to interpolate the string and cry
-                # if it has a stray % character so we must escape those
-                escaped_str = str(getattr(self, field.name)).replace('%', '%%')
-                config['DEFAULT'][field.name] = escaped_str
-        with open(filename, 'w', encoding='UTF-8') as configfile:
-            config.write(configfile)
+                escaped_str = str(getattr(self, name)).translate(_INI_ESCAPES)
+                config['DEFAULT'][name] = escaped_str
+        buffer = io.StringIO()
+        config.write(buffer)
+        _write_atomically(filename, buffer.getvalue())
 
     if _TOMLLIB_AVAILABLE:
         def save_all_to_toml(self, filename=_DEFAULT_TOML_FILENAME):
             """Write the current values of all our member variables to a TOML config file."""
-            with open(filename, 'w', encoding='UTF-8') as configfile:
-                for field in dataclasses.fields(self):
-                    if 'grammar' == field.name and self.grammar is None:
-                        continue
-                    value = getattr(self, field.name)
-                    # the string_letters variable is a list of strings internally
-                    if 'string_letters' == field.name:
-                        value = ''.join(self.string_letters)
-                    if type(value) is str:
-                        # N.B.: can't use repr(value) because Python and TOML treat single quotes
-                        # differently: Python interpolates inside single quotes but TOML does not
-                        value = value.replace('\\', r'\\')
-                        value = value.replace('"', r'\"')
-                        value = '"' + value + '"'
-                    # 'true' and 'false' are lowercase in TOML
-                    if type(value) is bool:
-                        value = str(value).lower()
-                    value = str(value)
-                    configfile.write(field.name + ' = ' + value + '\n')
+            lines = []
+            for name in _FIELD_NAMES:
+                if 'grammar' == name and self.grammar is None:
+                    continue
+                value = getattr(self, name)
+                # the string_letters variable is a list of strings internally
+                if 'string_letters' == name:
+                    value = ''.join(self.string_letters)
+                # the grammar class is a StrEnum and needs quoting as well
+                if isinstance(value, str):
+                    # N.B.: can't use repr(value) because Python and TOML treat single quotes
+                    # differently: Python interpolates inside single quotes but TOML does not
+                    value = '"' + value.translate(_TOML_ESCAPES) + '"'
+                # 'true' and 'false' are lowercase in TOML
+                if type(value) is bool:
+                    value = str(value).lower()
+                value = str(value)
+                lines.append(name + ' = ' + value + '\n')
+            _write_atomically(filename, ''.join(lines))
 
     def __setattr__(self, attr, value):
         """Save any and all settings changes automatically if required."""
+        unchanged = attr in self.__dict__ and self.__dict__[attr] == value
         super().__setattr__(attr, value)
-        if attr != 'autosave':
+        if attr != 'autosave' and not attr.startswith('_') and not unchanged:
             try:
                 if self.autosave:
-                    self.save_all_to_ini()
+                    self._schedule_autosave()
             except AttributeError:
                 pass  # that's fine
 
+    def __copy__(self):
+        """Copy the settings themselves, a pending autosave stays with the original."""
+        clone = self.__class__.__new__(self.__class__)
+        # straight into __dict__, a copy has nothing new to save
+        clone.__dict__.update((name, value) for name, value in self.__dict__.items() if not name.startswith('_'))
+        return clone
+
+    def _schedule_autosave(self):
+        """Save a little later so that a burst of changes only hits the disk once."""
+        with _AUTOSAVE_LOCK:
+            self._autosave_due_at = time.monotonic() + _AUTOSAVE_DELAY
+            if getattr(self, '_pending_autosave', None) is None:
+                # one waiting thread per burst, later changes only push its deadline back
+                self._pending_autosave = threading.Thread(target=self._autosave_when_due, daemon=True)
+                _PENDING_AUTOSAVES[id(self)] = self
+                self._pending_autosave.start()
+
+    def _autosave_when_due(self):
+        """Wait for the changes to settle down, then save them, runs in its own thread."""
+        while True:
+            with _AUTOSAVE_LOCK:
+                if self._pending_autosave is not threading.current_thread():
+                    return  # flushed in the meantime
+                remaining = self._autosave_due_at - time.monotonic()
+                if remaining <= 0:
+                    try:
+                        self._autosave()
+                    except Exception as err:  # e.g. a full disk, a traceback would land across a prompt
+                        # reported from the main thread, see pop_autosave_error
+                        self._autosave_error = err
+                    return
+            time.sleep(remaining)
+
+    def _autosave(self):
+        """Carry out a scheduled save, the caller holds _AUTOSAVE_LOCK."""
+        self._pending_autosave = None
+        _PENDING_AUTOSAVES.pop(id(self), None)
+        # a burst of changes may well have ended up where it started
+        snapshot = str(self)
+        if snapshot == getattr(self, '_autosaved_snapshot', None):
+            return
+        self.save_all_to_ini()
+        self._autosaved_snapshot = snapshot
+
+    def pop_autosave_error(self):
+        """Hand over the error a background save ran into, if any, so it can be reported at a good time."""
+        with _AUTOSAVE_LOCK:
+            err = getattr(self, '_autosave_error', None)
+            self._autosave_error = None
+        return err
+
+    def flush_autosave(self):
+        """Carry out a scheduled save right now instead of waiting for it."""
+        with _AUTOSAVE_LOCK:
+            if getattr(self, '_pending_autosave', None) is not None:
+                self._autosave()
+
+# the same for every instance, no need to look them up on each save
+_FIELD_NAMES = tuple(field.name for field in dataclasses.fields(Settings))
+_FIELD_PARSERS = {field.name: _PARSERS_BY_TYPE.get(field.type, field.type) for field in dataclasses.fields(Settings)}
+
+
+def _flush_pending_autosaves():
+    """Don't lose the last changes if we quit before they were saved."""
+    for pending_settings in list(_PENDING_AUTOSAVES.values()):
+        pending_settings.flush_autosave()
+
+atexit.register(_flush_pending_autosaves)
@@ -1,7 +1,9 @@
 """Peek in the setup.cfg file to find out the current version of the application."""
 
 import configparser
+import functools
 
+@functools.cache
 def get_version():
     """Return this application's current version number."""
     config = configparser.ConfigParser()
@@ -1,8 +1,10 @@
 """Unit tests to check basic expected behaviors."""
 
+import copy
 import math
 
 from src import grammar
+from src import settings
 
 
 def test_always_pass():
@@ -25,6 +27,41 @@ def test_grammar_exit_not_too_close():
         assert grammar.RegularGrammar.MIN_PATH_LENGTH <= g.shortest_path_through()
 
 
+def test_grammar_shortest_path_through():
+    """See if the shortest way to an accepting state is found, not just any way."""
+    assert 3 == grammar.REBER_1967.shortest_path_through()
+    assert 2 == grammar.REBER_1967.shortest_path_through(3)
+    assert 0 == grammar.REBER_1967.shortest_path_through(5)
+
+
+def test_grammar_is_connected():
+    """See if a grammar with every state reachable from the start is found connected."""
+    g = grammar.RegularGrammar()
+    g.transitions = [ {'S': 1, 'X': 2},
+                      {'M': 3},
+                      {'V': 4},
+                      {'M': 2},
+                      {'S': 5, 'X': 6},
+                      {'V': 1, 'R': 6},
+                      {None: None}
+                    ]
+    assert g.is_connected()
+
+
+def test_grammar_is_not_connected():
+    """See if a grammar with a state that can't be reached is found disconnected."""
+    g = grammar.RegularGrammar()
+    g.transitions = [ {'S': 1, 'X': 2},
+                      {'M': 3},
+                      {'V': 4},
+                      {'M': 2},
+                      {'X': 6},  # <- the only edge into 5 removed
+                      {'V': 1, 'R': 6},
+                      {None: None}
+                    ]
+    assert not g.is_connected()
+
+
 def test_grammar_has_cycle():
     """See if a cycle is found in a grammar that's not acyclic."""
     g = grammar.RegularGrammar()
@@ -151,7 +188,7 @@ def test_grammar_output_long_enough():
     for _ in range(100):
         g.randomize()
         output_strings = g.produce_grammatical(5)
-        assert not any(len(s) < grammar._MIN_STRING_LENGTH for s in output_strings)
+        assert grammar._MIN_STRING_LENGTH <= min(map(len, output_strings), default=math.inf)
 
 
 def test_grammar_output_short_enough():
@@ -160,7 +197,7 @@ def test_grammar_output_short_enough():
     for _ in range(100):
         g.randomize()
         output_strings = g.produce_grammatical(5)
-        assert not any(len(s) > grammar._MAX_STRING_LENGTH for s in output_strings)
+        assert max(map(len, output_strings), default=0) <= grammar._MAX_STRING_LENGTH
 
 
 def test_grammar_accepts_grammatical():
@@ -280,3 +317,138 @@ def test_grammar_predefined_knowlton_squire_1994_II():
     assert not grammar.KNOWLTON_SQUIRE_1994_II.recognize("PTSF")
     assert not grammar.KNOWLTON_SQUIRE_1994_II.recognize("TFT")
     assert not grammar.KNOWLTON_SQUIRE_1994_II.recognize("TPTPPT")
+
+
+def test_pattern_grammar_output_gives_up():
+    """See if asking for more strings than the pattern grammar can produce still terminates."""
+    g = grammar.PatternGrammar()
+    g.randomize()
+    output_strings = g.produce_grammatical(10 ** 6)
+    assert 0 < len(output_strings) < 10 ** 6
+
+
+def test_grammar_output_exact_length():
+    """See if strings of one exact length can be produced, including the maximum length."""
+    output_strings = grammar.REBER_1967.produce_grammatical(5, min_length=7, max_length=7)
+    assert 5 == len(output_strings)
+    assert all(7 == len(s) for s in output_strings)
+    assert all(grammar.REBER_1967.recognize(s) for s in output_strings)
+
+
+def test_grammar_ungrammatical_output_gives_up():
+    """See if asking for ungrammatical strings from a grammar that accepts everything still terminates."""
+    g = grammar.RegularGrammar(['M', 'R'])
+    g.transitions = [{'M': 0, 'R': 0, None: None}]
+    output_strings = g.produce_ungrammatical(5)
+    assert 0 == len(output_strings)
+
+
+def test_grammar_ungrammatical_output_mangles_foreign_letters():
+    """See if strings made of letters outside the grammar's symbols get mangled too, not thrown away."""
+    g = grammar.RegularGrammar(['M', 'R'], seed=1967)
+    g.transitions = [{'A': 1}, {'B': 2}, {None: None}]
+    output_strings = g.produce_ungrammatical(20)
+    # a single letter swapped out, a reversed string would still have both
+    assert any(1 == len({'A', 'B'} & set(s)) for s in output_strings)
+    assert not any(g.recognize(s) for s in output_strings)
+
+
+def test_grammar_seed_reproducible():
+    """See if two grammars seeded alike come up with the same grammar and the same strings."""
+    g1 = grammar.RegularGrammar(seed=1978)
+    g2 = grammar.RegularGrammar(seed=1978)
+    g1.randomize()
+    g2.randomize()
+    assert repr(g1) == repr(g2)
+    assert g1.produce_grammatical(5) == g2.produce_grammatical(5)
+    assert g1.produce_ungrammatical(5) == g2.produce_ungrammatical(5)
+
+
+def test_grammar_obfuscated_repr_roundtrip():
+    """See if a grammar survives being obfuscated and restored."""
+    g = grammar.RegularGrammar()
+    for _ in range(100):
+        g.randomize()
+        restored = grammar.RegularGrammar.from_obfuscated_repr(g.obfuscated_repr())
+        assert repr(g) == repr(restored)
+
+
+def test_pattern_grammar_classes_okay():
+    """See if symbol classes are accepted only if they cover exactly our symbols without partial overlaps."""
+    g = grammar.PatternGrammar(['M', 'R', 'S', 'V'])
+    g.classes = [{'M', 'R'}, {'S', 'V'}]
+    assert g.classes_okay()
+    g.classes = [{'M', 'R', 'S', 'V'}, {'M', 'R'}]  # nested is fine
+    assert g.classes_okay()
+    g.classes = [{'M', 'R', 'S'}, {'S', 'V'}]  # overlapping
+    assert not g.classes_okay()
+    g.classes = [{'M', 'R'}, {'S', 'V', 'X'}]  # X is not one of our symbols
+    assert not g.classes_okay()
+    g.classes = [{'M', 'R'}, {'S'}]  # V left out
+    assert not g.classes_okay()
+
+
+def test_settings_autosave_flush(tmp_path, monkeypatch):
+    """See if a burst of settings changes ends up in the settings file once flushed."""
+    monkeypatch.chdir(tmp_path)
+    # only flush_autosave may write the file, the timer must not beat it to it
+    monkeypatch.setattr(settings, '_AUTOSAVE_DELAY', 3600)
+    s = settings.Settings()
+    s.autosave = True
+    s.username = 'somebody'
+    s.training_time = 10
+    s.flush_autosave()
+    loaded = settings.Settings()
+    loaded.load_all_from_ini()
+    assert 'somebody' == loaded.username
+    assert 10 == loaded.training_time
+
+
+def test_pattern_grammar_recognizes_whole_strings_only():
+    """See if the pattern grammar refuses prefixes and extensions of a matching string."""
+    g = grammar.PatternGrammar()
+    g.classes = [{'M', 'R'}, {'S'}]
+    g.patterns = [[g.classes[0], g.classes[1], g.classes[0]]]
+    assert g.recognize('MSR')
+    assert not g.recognize('MS')
+    assert not g.recognize('MSRM')
+    assert not g.recognize('')
+
+
+def test_settings_autosave_skips_no_op(tmp_path, monkeypatch):
+    """See if assigning a setting its current value doesn't write the settings file."""
+    monkeypatch.chdir(tmp_path)
+    s = settings.Settings()
+    s.autosave = True
+    s.username = s.username
+    s.flush_autosave()
+    assert not (tmp_path / 'settings.ini').exists()
+
+
+def test_settings_copy_leaves_autosave_behind(tmp_path, monkeypatch):
+    """See if a copy of settings with a save pending neither shares nor triggers that save."""
+    monkeypatch.chdir(tmp_path)
+    # only flush_autosave may write the file, the timer must not beat it to it
+    monkeypatch.setattr(settings, '_AUTOSAVE_DELAY', 3600)
+    s = settings.Settings()
+    s.autosave = True
+    s.username = 'somebody'
+    s_copy = copy.copy(s)
+    assert s == s_copy
+    s_copy.flush_autosave()
+    assert not (tmp_path / 'settings.ini').exists()
+    s.flush_autosave()
+    assert (tmp_path / 'settings.ini').exists()
+
+
+def test_settings_toml_roundtrip(tmp_path, monkeypatch):
+    """See if settings saved in TOML format load back the same, quotes and backslashes included."""
+    monkeypatch.chdir(tmp_path)
+    s = settings.Settings()
+    s.username = 'some "body" \\ else'
+    s.grammar_class = settings.GrammarClass.PATTERN
+    s.recursion = False
+    s.save_all_to_toml()
+    loaded = settings.Settings()
+    loaded.load_all('settings.toml')
+    assert s == loaded